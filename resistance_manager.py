@@ -12,6 +12,83 @@ import niswitch
 import logging
 log = logging.getLogger(__name__)
 
+_PATH_EXISTS = niswitch.PathCapability.PATH_EXISTS.value
+
+# driver error codes meaning "this topology won't take a connection list",
+# the only case where the batched connect/disconnect falls back to per pair
+# calls. IVI_ERROR_FUNCTION_NOT_SUPPORTED (0xBFFA0011)
+_BATCH_UNSUPPORTED_CODES = (-1074135023,)
+
+# max number of resistance targets remembered per ResistanceManager
+TARGET_CACHE_SIZE = 256
+
+# generic subset sum table limits, in quarter ohms / table cells. above
+# these the DP table gets too big and the recursive solver is used instead
+SUBSET_SUM_MAX_TARGET = 1 << 16
+SUBSET_SUM_MAX_CELLS = 1 << 22
+
+try:
+    # numba (and the numpy it needs) only speed up the generic subset sum
+    import numpy as np
+    from numba import njit
+    NUMBA_AVAILABLE = True
+
+    @njit(cache=True)
+    def _subset_sum_dp(values, target):
+        """
+        iterative 0-1 subset sum over non-negative integer values.
+        returns a bool mask of the chosen values, picking the same subset as
+        the recursive SubsetSum._generic_g (earliest values preferred).
+        all False if target can't be reached.
+        """
+        n = values.shape[0]
+        # reach[i, j] -> j can be made from values[i:]
+        reach = np.zeros((n + 1, target + 1), dtype=np.uint8)
+        reach[n, 0] = 1
+        for i in range(n - 1, -1, -1):
+            v = values[i]
+            for j in range(target + 1):
+                r = reach[i + 1, j]
+                if j >= v:
+                    r |= reach[i + 1, j - v]
+                reach[i, j] = r
+
+        chosen = np.zeros(n, dtype=np.bool_)
+        remaining = target
+        for i in range(n):
+            v = values[i]
+            if v <= remaining and reach[i + 1, remaining - v]:
+                chosen[i] = True
+                remaining -= v
+        return chosen
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+def _subset_sum_bitset(values, target):
+    """
+    same contract as _subset_sum_dp, but each row of the reachability table
+    is a single python int (bit j set -> j reachable), so a row update is
+    one shift and one or: reach |= reach << v
+    """
+    n = len(values)
+    mask = (1 << (target + 1)) - 1
+    # reachables[i] -> sums that can be made from values[i:]
+    reachables = [0] * (n + 1)
+    reach = reachables[n] = 1
+    for i in range(n - 1, -1, -1):
+        reach = (reach | (reach << values[i])) & mask
+        reachables[i] = reach
+
+    chosen = [False] * n
+    remaining = target
+    for i in range(n):
+        v = values[i]
+        if v <= remaining and (reachables[i + 1] >> (remaining - v)) & 1:
+            chosen[i] = True
+            remaining -= v
+    return chosen
+
 class ResistanceManager:
     """
     ResistanceManager can manage 1 channel per instance
@@ -21,36 +98,78 @@ class ResistanceManager:
         self.topology=topo
         self.channel=channel
         self.connections=[]
-        self.bank_a, self.bank_b = self.getChannels()
+        # quarter-ohm target -> list of pairs, see get_banks_to_close_by_name
+        self._target_cache = {}
+        self._session = niswitch.Session(self.device, topology=self.topology)
+        self.bank_a, self.bank_b = self.getChannels(self._session)
 
-    def __del__(self):
-        self.clearWholeChannel()
+        # See NI specs, the available resistance values in ohms.
+        # bank0 is the even bank, bank1 the odd bank
+        self._even_bank = (.25,.5,1,2,4,8,16,32)
+        self._odd_bank  = (64,128,256,512,1024,2048,4096,8192)
+
+        self._prefix_A = self.bank_a[0] # e.g. 'b0', sure hope the order is always the same
+        self._prefix_B = self.bank_b[0] # e.g. 'b1'
+        self._a_engage = self.bank_a[1] # e.g. 'b0engage'
+        self._b_engage = self.bank_b[1]
+
+        # bank names in value order, index 0 = .25 (bank0) / 64 (bank1)
+        self._bank0_names = tuple(self.bank_a[2:10])
+        self._bank1_names = tuple(self.bank_b[2:10])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
+    def __del__(self):
+        # may run on a half built instance or during interpreter shutdown
+        try:
+            self.close()
+        except Exception:
+            pass
 
-    def getChannels(self):
+    def close(self):
+        """
+        clear the channel and close the niswitch session held by this
+        instance. safe to call more than once
+        """
+        session = getattr(self, '_session', None)
+        if session is None:
+            return
+        try:
+            if hasattr(self, '_bank1_names'): # __init__ got all the way through
+                self.clearWholeChannel()
+        finally:
+            self._session = None
+            session.close()
+
+    def getChannels(self, session_matrix=None):
         """
         returns 2 lists of all valid bank names for the given channel
         returns 'b0r1', 'b0engage' style names
         """
+        if session_matrix is None:
+            session_matrix = self._session
+
         prefix_bank_A="b"+str(self.channel*2)
         prefix_bank_B="b"+str((self.channel*2)+1)
 
-        with niswitch.Session(self.device,
-                              topology=self.topology) as session_matrix:
-            channel_names = []
-            for i in range(1, 99999):
-                try:
-                    channel_names.append(session_matrix.get_channel_name(i))
-                except niswitch.errors.Error as e:
-                    break
-
-            b0 = [col for col in channel_names if col.startswith(prefix_bank_A)]
-            b1 = [row for row in channel_names if row.startswith(prefix_bank_B)]
+        get_channel_name = session_matrix.get_channel_name
+        b0 = []
+        b1 = []
+        for i in range(1, session_matrix.channel_count + 1):
+            name = get_channel_name(i)
+            if name.startswith(prefix_bank_A):
+                b0.append(name)
+            if name.startswith(prefix_bank_B):
+                b1.append(name)
 
-            log.debug(b0)
-            log.debug(b1)
+        log.debug(b0)
+        log.debug(b1)
 
-            return (b0, b1)
+        return (b0, b1)
 
     def setResistance(self, resistance_ohms):
         """
@@ -58,10 +177,22 @@ class ResistanceManager:
         """
         self.clearWholeChannel()
 
-        with niswitch.Session(self.device, topology=self.topology) as ni_session:
-            for a, b in self.get_banks_to_close_by_name(resistance_ohms):
-                log.debug('closing %s %s' % (a, b))
-                ni_session.connect( a, b )
+        pairs = self.get_banks_to_close_by_name(resistance_ohms)
+        if not pairs:
+            return
+
+        log.debug('closing %s' % (pairs,))
+        spec = ",".join("%s->%s" % (a, b) for a, b in pairs)
+        ni_session = self._session
+        try:
+            ni_session.connect_multiple(spec)
+        except niswitch.errors.DriverError as e:
+            if e.code not in _BATCH_UNSUPPORTED_CODES:
+                raise
+            # topology doesn't take the batched form, do it one at a time
+            for a, b in pairs:
+                if _PATH_EXISTS != ni_session.can_connect(a, b).value:
+                    ni_session.connect( a, b )
 
 
     def get_banks_to_close_by_name(self, resistance):
@@ -71,7 +202,14 @@ class ResistanceManager:
         retConnections = []
         if resistance >= 0 and resistance <= 16000:
 
-            resistance = round(resistance*4)/4 # round to nearest .25
+            q = int(round(resistance*4)) # nearest .25 ohm, in quarter ohms
+
+            # bank names are fixed after __init__, so the pairs for a given
+            # quarter-ohm target never change
+            cached = self._target_cache.get(q)
+            if cached is not None:
+                self.connections[:] = cached
+                return list(cached)
 
             """ See NI specs
                 These are the available resistance values in ohms. 
@@ -80,53 +218,38 @@ class ResistanceManager:
                 with sum of 1,2,64
             """
 
-            even_bank = [.25,.5,1,2,4,8,16,32]
-            odd_bank  = [64,128,256,512,1024,2048,4096,8192]
-
-            sum, values = SubsetSum.get_banks_to_leave_open(even_bank+odd_bank, resistance);
-
-            bank0_close = set(even_bank) - set( values )
-            bank1_close = set(odd_bank)  - set( values )
-
-            prefix_bank_A=self.bank_a[0] # e.g. 'b0', sure hope the order is always the same
-            prefix_bank_B=self.bank_b[0] # e.g. 'b1'
-
-            a_engage=self.bank_a[1] # e.g. 'b0engage'
-            b_engage=self.bank_b[1]
+            # every value in _even_bank/_odd_bank is .25 * 2**k, so the banks to
+            # leave open are just the bits of the quarter-ohm count.
+            # close whatever is not set.
+            n_even = len(self._even_bank)
+            n_odd = len(self._odd_bank)
+            open0, open1 = SubsetSum.get_open_masks(q, n_even, n_odd)
+            bank0_close_mask = ~open0 & ((1 << n_even) - 1)
+            bank1_close_mask = ~open1 & ((1 << n_odd) - 1)
 
-            bank0_dict = {}
-            bank0_dict[.25] = self.bank_a[2]
-            bank0_dict[.5 ] = self.bank_a[3]
-            bank0_dict[1]   = self.bank_a[4]
-            bank0_dict[2]   = self.bank_a[5]
-            bank0_dict[4]   = self.bank_a[6]
-            bank0_dict[8]   = self.bank_a[7]
-            bank0_dict[16]  = self.bank_a[8]
-            bank0_dict[32]  = self.bank_a[9]
-
-            bank1_dict = {}
-            bank1_dict[64  ] = self.bank_b[2]
-            bank1_dict[128 ] = self.bank_b[3]
-            bank1_dict[256 ] = self.bank_b[4]
-            bank1_dict[512 ] = self.bank_b[5]
-            bank1_dict[1024] = self.bank_b[6]
-            bank1_dict[2048] = self.bank_b[7]
-            bank1_dict[4096] = self.bank_b[8]
-            bank1_dict[8192] = self.bank_b[9]
+            prefix_bank_A = self._prefix_A
+            prefix_bank_B = self._prefix_B
 
             connections = self.connections
             connections.clear()
 
-            connections.append( (prefix_bank_A, a_engage) )
-            connections.append( (prefix_bank_B, b_engage) )
+            connections.append( (prefix_bank_A, self._a_engage) )
+            connections.append( (prefix_bank_B, self._b_engage) )
             connections.append( (prefix_bank_A, prefix_bank_B) ) # connect the 2 banks
-            for bank in bank0_close:
-                connections.append( (prefix_bank_A, bank0_dict[bank]) )
+            for bit in range(n_even):
+                if (bank0_close_mask >> bit) & 1:
+                    connections.append( (prefix_bank_A, self._bank0_names[bit]) )
 
-            for bank in bank1_close:
-                connections.append( (prefix_bank_B, bank1_dict[bank]) )
+            for bit in range(n_odd):
+                if (bank1_close_mask >> bit) & 1:
+                    connections.append( (prefix_bank_B, self._bank1_names[bit]) )
 
             retConnections.extend(connections)
+
+            if len(self._target_cache) >= TARGET_CACHE_SIZE:
+                # drop the oldest entry
+                del self._target_cache[next(iter(self._target_cache))]
+            self._target_cache[q] = list(connections)
         else:
             # Failure case (resistance out of range).
             log.debug("'resistance' parameter (%.2f) is out of range."%resistance)
@@ -139,21 +262,30 @@ class ResistanceManager:
         """
         check all possible connections and disconnect if needed
         """
-        with niswitch.Session(self.device, topology=self.topology) as ni_session:
-            def checkAndDisconnect(a,b):
-                state = ni_session.can_connect(a, b)
-                if niswitch.PathCapability.PATH_EXISTS.value == state.value:
-                    log.debug('disconnecting: %s %s' % (a, b))
+        ni_session = self._session
+
+        candidates = [(self._prefix_A, n) for n in self.bank_a[1:]]
+        candidates += [(self._prefix_B, n) for n in self.bank_b[1:]]
+        candidates.append( (self._prefix_A, self._prefix_B) )
+
+        can_connect = ni_session.can_connect
+        existing = [(a, b) for a, b in candidates
+                    if _PATH_EXISTS == can_connect(a, b).value]
+        if not existing:
+            return
+
+        log.debug('disconnecting: %s' % (existing,))
+        spec = ",".join("%s->%s" % (a, b) for a, b in existing)
+        try:
+            ni_session.disconnect_multiple(spec)
+        except niswitch.errors.DriverError as e:
+            if e.code not in _BATCH_UNSUPPORTED_CODES:
+                raise
+            # topology doesn't take the batched form, do it one at a time
+            for a, b in existing:
+                if _PATH_EXISTS == can_connect(a, b).value:
                     ni_session.disconnect( a, b )
 
-            for n in self.bank_a[1:]:
-                checkAndDisconnect(self.bank_a[0], n)
-
-            for n in self.bank_b[1:]:
-                checkAndDisconnect(self.bank_b[0], n)
-
-            checkAndDisconnect(self.bank_a[0], self.bank_b[0])
-
 
 class SubsetSum:
     """ 
@@ -162,40 +294,91 @@ class SubsetSum:
         subset sum algorithm used to calculate relays to close in the PXI-2722
         resistance module card. RTFM for PXI-2722.
 
-        return a tuple (target_sum, list of values that make up the target sum)  
-            `target_sum -- if a subset was found, else 0`
+        get_open_masks(scaled_target) -- PXI-2722 banks only (.25 * 2**k
+            ohms). returns (mask0, mask1), the bits of the quarter-ohm target
+            for the low and high bank
 
-        This class uses recursive function calls and 'memoization' to solve a 
-        0-1 Knapsack problem.  Given a set v, and a target value S, these 
-        methods will return a subset of values from within v which sums to S, 
-        if such a subset exists.
+        get_banks_to_leave_open(x_list, target) -- returns a tuple
+            (target_sum, list of values from x_list that sum to target),
+            target_sum is 0 if no subset exists. reads the bits directly for
+            the PXI-2722 value list, otherwise calls the generic version
+
+        get_banks_to_leave_open_generic(x_list, target) -- same return, any
+            value list. bitset (or numba) DP over quarter-ohm scaled values,
+            the recursive memoized 0-1 knapsack from saltycrane otherwise
 
         See: https://github.com/saltycrane/subset-sum/tree/master/subsetsum
     """
     @staticmethod
     def get_banks_to_leave_open(x_list, target):
+        if not SubsetSum.is_quarter_ohm_binary(x_list):
+            return SubsetSum.get_banks_to_leave_open_generic(x_list, target)
+
+        q = int(round(target*4))
+        if q != target*4 or q < 0 or q >> len(x_list):
+            # not a whole number of quarter ohms, or out of range
+            return (0, [])
+        values = [v for k, v in enumerate(x_list) if (q >> k) & 1]
+        return (sum(values), values)
+
+    @staticmethod
+    def get_open_masks(scaled_target, low_bits=8, high_bits=8):
+        """
+        PXI-2722 fast path. scaled_target is the resistance in quarter ohms.
+        returns (mask0, mask1), bit k set -> leave bank k open, for the low
+        (.25 .. 32) and high (64 .. 8192) banks
+        """
+        mask0 = scaled_target & ((1 << low_bits) - 1)
+        mask1 = (scaled_target >> low_bits) & ((1 << high_bits) - 1)
+        return (mask0, mask1)
+
+    @staticmethod
+    def is_quarter_ohm_binary(x_list):
+        """ True if x_list is exactly [.25, .5, 1, 2, ...] """
+        return all(v == .25 * (1 << k) for k, v in enumerate(x_list))
+
+    @staticmethod
+    def get_banks_to_leave_open_generic(x_list, target):
+        # values here are quarter-ohm resolution, scale to integers
+        scaled = [v*4 for v in x_list]
+        if (0 <= target*4 <= SUBSET_SUM_MAX_TARGET
+                and (len(x_list) + 1) * (target*4 + 1) <= SUBSET_SUM_MAX_CELLS
+                and target*4 == int(target*4)
+                and all(v >= 0 and v == int(v) for v in scaled)):
+            scaled = [int(v) for v in scaled]
+            scaled_target = int(target*4)
+            if NUMBA_AVAILABLE:
+                chosen = _subset_sum_dp(np.array(scaled, dtype=np.int64),
+                                        scaled_target)
+            else:
+                chosen = _subset_sum_bitset(scaled, scaled_target)
+            result = [x for x, c in zip(x_list, chosen) if c]
+            return (sum(result), result)
+
+        # pure python reference, for values that aren't quarter-ohm multiples
+        # or targets too big for the tables above
         memo = dict()
-        result, _ = SubsetSum.g(x_list, x_list, target, memo)
+        result, _ = SubsetSum._generic_g(x_list, x_list, target, memo)
         return (sum(result), result)
 
     @staticmethod
-    def g(v_list, w_list, target_Sum, memo):
+    def _generic_g(v_list, w_list, target_Sum, memo):
         subset = []
         id_subset = []
         for i, (x, y) in enumerate(zip(v_list, w_list)):
             # Check if there is still a solution if we include v_list[i]
-            if SubsetSum.f(v_list, i + 1, target_Sum - x, memo) > 0:
+            if SubsetSum._generic_f(v_list, i + 1, target_Sum - x, memo) > 0:
                 subset.append(x)
                 id_subset.append(y)
                 target_Sum -= x
         return subset, id_subset
 
     @staticmethod
-    def f(v_list, i, target_Sum, memo):
+    def _generic_f(v_list, i, target_Sum, memo):
         if i >= len(v_list):
             return 1 if target_Sum == 0 else 0
         if (i, target_Sum) not in memo:    # <-- Check if value has not been calculated.
-            count = SubsetSum.f(v_list, i + 1, target_Sum, memo)
-            count += SubsetSum.f(v_list, i + 1, target_Sum - v_list[i], memo)
+            count = SubsetSum._generic_f(v_list, i + 1, target_Sum, memo)
+            count += SubsetSum._generic_f(v_list, i + 1, target_Sum - v_list[i], memo)
             memo[(i, target_Sum)] = count  # <-- Memoize calculated result.
         return memo[(i, target_Sum)]       # <-- Return memoized value.
@@ -4,42 +4,72 @@ author Jeff Charter Chapman
 """
 import sys
 import numpy as np
-import pandas as pd
 import niswitch
 
 import logging
 log = logging.getLogger(__name__)
 
+_PATH_EXISTS = niswitch.PathCapability.PATH_EXISTS.value
+
+
+def _path_key(a, b):
+    # niswitch paths have no direction, 'r2'->'c5' is 'c5'->'r2'
+    return frozenset((a, b))
+
 
 class SwitchManager:
     """
     wrapper around national instruments nimi-python niswitch to simplify use of 
     a PXI switch matrix.
     """
+    # pandas is only needed by getConnections(), imported on first use
+    _pd = None
 
     def __init__(self, device="PXI1Slot8", topo="2531/1-Wire 8x64 Matrix"):
         self.device=device
         self.topology=topo
-        self.cols, self.rows = self.getChannels()
+        self._session = niswitch.Session(self.device, topology=self.topology)
+        self.cols, self.rows = self.getChannels(self._session)
+        # paths we believe are connected, as _path_key()s, see resync()
+        self._closed = set()
+        self.resync()
+
+    def __del__(self):
+        # may run on a half built instance or during interpreter shutdown
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """
+        close the niswitch session held by this instance
+        """
+        session = getattr(self, '_session', None)
+        if session is not None:
+            self._session = None
+            session.close()
 
 
-    def getChannels(self):
+    def getChannels(self, session_matrix=None):
         """
         returns 2 lists of all valid (columns, rows)
         returns 'r1', 'c1' style names
         """
-        with niswitch.Session(self.device,
-                              topology=self.topology) as session_matrix:
-            channel_names = []
-            for i in range(1, 99999):
-                try:
-                    channel_names.append(session_matrix.get_channel_name(i))
-                except niswitch.errors.Error as e:
-                    break
-            columns = [col for col in channel_names if col.startswith('c')]
-            rows = [row for row in channel_names if row.startswith('r')]
+        if session_matrix is None:
+            session_matrix = self._session
+
+        get_channel_name = session_matrix.get_channel_name
+        columns = []
+        rows = []
+        for i in range(1, session_matrix.channel_count + 1):
+            name = get_channel_name(i)
+            if name.startswith('c'):
+                columns.append(name)
+            elif name.startswith('r'):
+                rows.append(name)
 
-            return (columns, rows)
+        return (columns, rows)
 
 
     def getConnections(self, row_slice=(0, None), col_slice=(0, None)):
@@ -71,92 +101,114 @@ class SwitchManager:
         # print(getConnections()['c62'])
         """
 
-        # create an empty numpy matrix with the expected size
-        mat = np.zeros( 
-            shape = (
-                len(self.rows[row_slice[0]:row_slice[1]]),
-                len(self.cols[col_slice[0]:col_slice[1]]) ), 
-            dtype='int32' )
+        rows_slice = self.rows[row_slice[0]:row_slice[1]]
+        cols_slice = self.cols[col_slice[0]:col_slice[1]]
+
+        mat = self._scan(rows_slice, cols_slice)
+
+        if SwitchManager._pd is None:
+            import pandas as pd
+            SwitchManager._pd = pd
+        return SwitchManager._pd.DataFrame(mat, index=rows_slice, columns=cols_slice)
+
+
+    def _scan(self, rows, cols):
+        """
+        returns a len(rows) x len(cols) int32 numpy array of
+        niswitch.PathCapability values
+        """
+        # niswitch has no bulk query, so ask for each pair, but stream the
+        # answers straight into a preallocated array
+        can_connect = self._session.can_connect
+        gen = (can_connect(r, c).value for r in rows for c in cols)
+        return np.fromiter(gen, dtype=np.int32,
+                           count=len(rows)*len(cols)).reshape(len(rows), len(cols))
+
 
-        # convert it to a pandas DataFrame
-        connections = pd.DataFrame(mat,
-                                   columns=self.cols[col_slice[0]:col_slice[1]],
-                                   index=self.rows[row_slice[0]:row_slice[1]],dtype=object)
+    def _scan_row(self, row):
+        """
+        returns (1-d array of PathCapability values, column names) for one row
+        """
+        cols = self.cols
+        return self._scan([row], cols)[0], cols
 
-        # get the current state of everything requested
-        with niswitch.Session(self.device,
-                              topology=self.topology) as session_matrix:
-            for r in self.rows[row_slice[0]:row_slice[1]]:
-                for c in self.cols[col_slice[0]:col_slice[1]]:
-                    state = session_matrix.can_connect(r, c)
-                    connections[c][r] = state.value
 
-        return connections
+    def _scan_col(self, col):
+        """
+        returns (1-d array of PathCapability values, row names) for one column
+        """
+        rows = self.rows
+        return self._scan(rows, [col])[:, 0], rows
 
 
     def clearRow(self, row):
         """
         clear all connections on row. example input for row is 'r1'
         """
-        # e.g. 'r1' -> 1, 'r11' -> 11
-        row_as_val = int(''.join(filter(str.isdigit, row)))
-
-        row_connections = self.getConnections(row_slice=(row_as_val, row_as_val+1))
-        for col in self.cols:
-            if niswitch.PathCapability.PATH_EXISTS.value == row_connections[col][row]:
-                with niswitch.Session(self.device,
-                                      topology=self.topology) as session_matrix:
-                    log.debug("disconnecting %s->%s" % (row, col))
-                    session_matrix.disconnect(channel1=row, channel2=col)
+        mat, col_names = self._scan_row(row)
+        session_matrix = self._session
+        for j in np.flatnonzero(mat == _PATH_EXISTS):
+            col = col_names[j]
+            log.debug("disconnecting %s->%s" % (row, col))
+            session_matrix.disconnect(channel1=row, channel2=col)
+            self._closed.discard(_path_key(row, col))
 
 
     def clearCol(self,col):
         """
         clear all connections on col. example input for col is 'c60'
         """
-        # e.g. 'c1' -> 1
-        col_as_val = int(''.join(filter(str.isdigit, col)))
-
-        col_connections = self.getConnections(
-            col_slice=(col_as_val, col_as_val+1))
-        for row in self.rows:
-            if niswitch.PathCapability.PATH_EXISTS.value == col_connections[col][row]:
-                with niswitch.Session(self.device,
-                                      topology=self.topology) as session_matrix:
-                    log.debug("disconnecting %s->%s" % (row, col))
-                    session_matrix.disconnect(channel1=row, channel2=col)
+        mat, row_names = self._scan_col(col)
+        session_matrix = self._session
+        for i in np.flatnonzero(mat == _PATH_EXISTS):
+            row = row_names[i]
+            log.debug("disconnecting %s->%s" % (row, col))
+            session_matrix.disconnect(channel1=row, channel2=col)
+            self._closed.discard(_path_key(row, col))
 
 
     def connect(self,row,col):
         """
         if connection already there leave, otherwise make it.
+        uses the locally tracked state, call resync() first if something
+        else may have touched the matrix.
         """
-        with niswitch.Session(self.device, topology=self.topology) as session_matrix:
-            if( not session_matrix.can_connect(channel1=row, channel2=col)
-                    == niswitch.PathCapability.PATH_EXISTS ):
-                log.debug("connecting %s->%s" % (row, col))
-                session_matrix.connect(channel1=row, channel2=col)
+        if _path_key(row, col) in self._closed:
+            return
+        log.debug("connecting %s->%s" % (row, col))
+        self._session.connect(channel1=row, channel2=col)
+        self._closed.add(_path_key(row, col))
 
     def disconnect(self, row, col):
         """
         analagous to connect()
         if connection not there leave, otherwise disconnect.
         """
-        with niswitch.Session(self.device, topology=self.topology) as session_matrix:
-            if( session_matrix.can_connect(channel1=row, channel2=col)
-                   == niswitch.PathCapability.PATH_EXISTS ):
-                log.debug("disconnecting %s->%s" % (row, col))
-                session_matrix.disconnect(channel1=row, channel2=col)
+        if _path_key(row, col) not in self._closed:
+            return
+        log.debug("disconnecting %s->%s" % (row, col))
+        self._session.disconnect(channel1=row, channel2=col)
+        self._closed.discard(_path_key(row, col))
+
+    def resync(self):
+        """
+        re-read the connection state from the hardware. needed if anything
+        outside this instance may have changed the matrix.
+        """
+        mat = self._scan(self.rows, self.cols)
+        self._closed = {_path_key(self.rows[i], self.cols[j])
+                        for i, j in zip(*np.nonzero(mat == _PATH_EXISTS))}
 
     def reset(self):
         # reset switch matrix
-        with niswitch.Session(self.device, topology=self.topology, reset_device=True) as session_matrix:
-            log.debug("resetting niswitch")
+        log.debug("resetting niswitch")
+        self._session.reset()
+        self._closed.clear()
 
     def disconnect_all(self):
-        with niswitch.Session(self.device, topology=self.topology) as session_matrix:
-            log.debug("disconnecting all")
-            session_matrix.disconnect_all()
+        log.debug("disconnecting all")
+        self._session.disconnect_all()
+        self._closed.clear()
 
 
 if __name__ == "__main__":